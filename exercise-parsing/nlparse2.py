@@ -1,82 +1,252 @@
 """Функциональный синтаксический анализ"""
-import re
 
 class Constituent:
     """Класс-контейнер для составляющих, содержит три атрибута:
     - tag: метка категории (или None)
     - children: дочерние составляющие
-    - words: линейный список слов составляющей"""
+    - words: линейный список слов составляющей
 
-    def __init__(self, tag=None, children=(), words=()):
+    Составляющие неизменяемы после создания, поэтому класс объявляет
+    __slots__ (составляющих создаются миллионы при больших разборах),
+    а хеш и строковое представление кэшируются.
+
+    Слова хранятся кусками в _word_chunks (кортеж кортежей): конкатенация
+    составляющих тогда лишь складывает кортежи кусков за O(числа кусков),
+    не переписывая сами слова, а линейный кортеж words склеивается
+    лениво при первом обращении"""
+
+    __slots__ = ('tag', 'children', '_word_chunks', '_words', '_hash', '_str')
+
+    def __init__(self, tag=None, children=(), words=None, word_chunks=None):
         self.tag = tag
         self.children = children
-        self.words = words
-        
+        if word_chunks is None:
+            words = tuple(words) if words is not None else ()
+            self._word_chunks = (words,) if words else ()
+            self._words = words
+        else:
+            self._word_chunks = word_chunks
+            self._words = None
+        self._hash = None
+        self._str = None
+
+    @property
+    def words(self):
+        """Линейный кортеж слов составляющей; склеивается из кусков
+        при первом обращении и кэшируется"""
+        ws = self._words
+        if ws is None:
+            ws = self._words = tuple(w for chunk in self._word_chunks
+                                     for w in chunk)
+        return ws
+
     def __add__(self, other):
-        """Конкатенация для составляющих (поддержка оператора +)"""
+        """Конкатенация для составляющих (поддержка оператора +);
+        куски слов складываются без переписывания самих слов"""
 
         return Constituent(children=(self, other),
-                           words=self.words + other.words)
+                           word_chunks=self._word_chunks + other._word_chunks)
 
     def __matmul__(self, tag):
         """Добавление метки к составляющей (поддержка оператора @)"""
 
-        return Constituent(tag=tag, children=self.children, words=self.words)
+        return Constituent(tag=tag, children=self.children,
+                           word_chunks=self._word_chunks)
 
     def __str__(self):
-        """Строковое представление составляющей (поддержка str(c))"""
+        """Строковое представление составляющей (поддержка str(c)).
 
-        if self.children:
-            arguments = ','.join([ str(child) for child in self.children])
-        else:
-            arguments = ','.join(self.words)
+        Составляющие неизменяемы, поэтому построенная строка лениво
+        кэшируется: повторные str(c) по глубокому дереву не
+        перестраивают строки детей заново"""
 
-        return f"{self.tag if self.tag is not None else ''}({arguments})"
+        s = self._str
+        if s is None:
+            if self.children:
+                arguments = ','.join([ str(child) for child in self.children])
+            else:
+                arguments = ','.join(self.words)
+
+            s = f"{self.tag if self.tag is not None else ''}({arguments})"
+            self._str = s
+
+        return s
     
     def __eq__(self, other):
-        """Сравнивает две составляющие по содержимому, а не по уникальным идентификаторам."""
-        if isinstance(other, Constituent):
-            return self.tag == other.tag and self.children == other.children and self.words == other.words
-        return False
+        """Сравнивает две составляющие по содержимому, а не по уникальным
+        идентификаторам. Сначала дешевые проверки: идентичность объектов
+        и сравнение кэшированных хешей."""
+        if self is other:
+            return True
+        if not isinstance(other, Constituent):
+            return False
+        if hash(self) != hash(other):
+            return False
+        return (self.tag == other.tag and self.children == other.children
+                and self.words == other.words)
 
     def __ne__(self, other):
         """Определяет неравенство двух составляющих."""
         return not self.__eq__(other)
+
+    def __hash__(self):
+        """Возвращает хеш по содержимому, лениво вычисленный при первом
+        обращении (составляющие могут служить ключами словарей и кэшей)."""
+        h = self._hash
+        if h is None:
+            h = self._hash = hash((self.tag, self.children, self.words))
+        return h
     def __repr__(self):
         return f"Constituent(tag={self.tag}, children={self.children}, words={self.words})"
 
+_WORD_ID = {}
+_ID_WORD = []
+
+def _intern(w):
+    """Возвращает целочисленный идентификатор слова w, добавляя слово в
+    таблицы соответствия при первой встрече. Парсеры сравнивают токены
+    как маленькие целые числа, а не как строки; строка нужна только для
+    отображения составляющих"""
+    wid = _WORD_ID.get(w)
+    if wid is None:
+        wid = _WORD_ID[w] = len(_ID_WORD)
+        _ID_WORD.append(w)
+    return wid
+
+def tokenize(tokens):
+    """Переводит цепочку слов в кортеж целочисленных идентификаторов.
+    Неизвестные грамматике слова получают -1 и заведомо не совпадут
+    ни с одним парсером"""
+    return tuple(_WORD_ID.get(w, -1) for w in tokens)
+
+_MEMO = {}
+_MEMO_TOKENS = None
+
+def memo(call):
+    """Декоратор пакрат-мемоизации для методов __call__ парсеров.
+
+    Результаты вызова кэшируются по ключу (id(парсера), позиция), так что
+    каждая пара (парсер, позиция) разбирается не более одного раза и
+    худший случай становится линейным по длине цепочки вместо
+    экспоненциального. Кэш действителен только для одной входной цепочки
+    и очищается, как только приходит другая."""
+
+    def wrapper(self, tokens, pos=0):
+        global _MEMO_TOKENS
+        # горячий путь: глобальная таблица привязывается к локальному
+        # имени, чтобы не искать ее в глобальном словаре на каждом шаге
+        table = _MEMO
+        if tokens is not _MEMO_TOKENS:
+            table.clear()
+            _MEMO_TOKENS = tokens
+        key = (id(self), pos)
+        results = table.get(key)
+        if results is None:
+            table[key] = results = list(call(self, tokens, pos))
+        yield from results
+
+    return wrapper
+
 class Parser:
     """Базовый класс парсеров, реализует только поддержку операторов"""
 
     def __add__(self, other):
-        """Конкатенация парсеров (поддержка оператора +)"""
-        return SeqParser(self, other)
+        """Конкатенация парсеров (поддержка оператора +).
+
+        Смежные конкатенации сливаются в один плоский ConcatParser,
+        чтобы a + b + c + d не строил дерево вложенных пар"""
+        if isinstance(self, ConcatParser):
+            if isinstance(other, ConcatParser):
+                return ConcatParser(*self.ps, *other.ps)
+            return ConcatParser(*self.ps, other)
+        if isinstance(other, ConcatParser):
+            return ConcatParser(self, *other.ps)
+        return ConcatParser(self, other)
 
     def __or__(self, other):
-        """Альтерация парсеров (поддержка оператора |)"""
-        return AltParser(self, other)
+        """Альтерация парсеров (поддержка оператора |).
+
+        Чистые однословные парсеры (WordParser, SetWordParser)
+        сливаются в один SetWordParser, так что цепочка
+        word('a') | word('an') | word('the') строится как одна
+        проверка принадлежности множеству"""
+        ws1 = _word_set(self)
+        ws2 = ws1 and _word_set(other)
+        if ws2:
+            return SetWordParser(ws1 | ws2)
+        if isinstance(self, AltParserN):
+            if isinstance(other, AltParserN):
+                return AltParserN(*self.ps, *other.ps)
+            return AltParserN(*self.ps, other)
+        if isinstance(other, AltParserN):
+            return AltParserN(self, *other.ps)
+        return AltParserN(self, other)
 
     def __matmul__(self, tag):
         """Добавление категориальной метки (поддержка оператора @)"""
         return TagParser(tag, self)
 
-    def __call__(self, tokens):
+    def lookahead(self, guard, predicate=None):
+        """Страж по токенам: возвращает парсер, который запускает self,
+        только если guard(tokens, pos) истинен. Необязательный predicate
+        --- эквивалентная проверка по построенной составляющей для
+        бэкендов, не исполняющих __call__ (см. GuardParser)"""
+        return GuardParser(self, guard, predicate)
+
+    def __call__(self, tokens, pos=0):
         """Все подклассы должны переопределить этот метод так, чтобы
-        он возвращал генератор (yield), выдающий пары (составляющая, хвост цепочки)"""
+        он возвращал генератор (yield), выдающий пары (составляющая, позиция
+        после нее). Цепочка tokens не изменяется и не копируется: парсеры
+        передают друг другу только целочисленную позицию pos"""
         pass
-        
+
 class WordParser(Parser):
     """Парсер, который принимает ровно одно заданное слово"""
 
     def __init__(self, w):
         self.w = w
+        self.wid = _intern(w)
+        # составляющие неизменяемы, поэтому лист строится один раз
+        # на парсер и дальше только переиспользуется
+        self._leaf = Constituent(words=(w,))
 
-    def __call__(self, tokens):
+    def __call__(self, tokens, pos=0):
         """Генератор порождает не более одной пары, где в составляющей тег пустой,
-        детей нет, а список слов состоит из одного слова"""
-        if len(tokens) > 0 and tokens[0] == self.w:
-            yield (Constituent(words=(self.w,)), tokens[1:])
+        детей нет, а список слов состоит из одного слова. Сравнение ---
+        по целочисленному идентификатору слова"""
+        if pos < len(tokens) and tokens[pos] == self.wid:
+            yield (self._leaf, pos + 1)
+
+
+class SetWordParser(Parser):
+    """Парсер, который принимает ровно одно слово из заданного множества.
+
+    Альтерация чистых однословных парсеров сливается оператором | в один
+    такой парсер: вместо k последовательных сравнений --- одна проверка
+    принадлежности frozenset, а составляющие-листья построены заранее,
+    по одной на слово"""
+
+    def __init__(self, ws):
+        self.words = frozenset(ws)
+        self.ws = frozenset(_intern(w) for w in self.words)
+        self.cache = {_intern(w): Constituent(words=(w,)) for w in self.words}
 
+    def __call__(self, tokens, pos=0):
+        """Генератор порождает не более одной пары с заранее
+        построенной составляющей-листом"""
+        if pos < len(tokens):
+            wid = tokens[pos]
+            if wid in self.ws:
+                yield (self.cache[wid], pos + 1)
+
+def _word_set(p):
+    """Возвращает множество слов однословного парсера p или None,
+    если p не однословный"""
+    if isinstance(p, WordParser):
+        return frozenset((p.w,))
+    if isinstance(p, SetWordParser):
+        return p.words
+    return None
 
 class SeqParser(Parser):
     """Парсер --- конкатенация парсеров"""
@@ -85,26 +255,124 @@ class SeqParser(Parser):
         self.p1 = p1
         self.p2 = p2
 
-    def __call__(self, tokens):
-        """Сначала вызывается парсер p1, потом для каждого возможного хвоста
+    @memo
+    def __call__(self, tokens, pos=0):
+        """Сначала вызывается парсер p1, потом для каждой возможной позиции
         вызывается парсер p2. Результирующая составляющая есть конкатенация
         составляющих с пустым тегом"""
-        for c1, tokens1 in self.p1(tokens):
-            for c2, tokens2 in self.p2(tokens1):
-                yield (c1 + c2, tokens2)
+        for c1, pos1 in self.p1(tokens, pos):
+            for c2, pos2 in self.p2(tokens, pos1):
+                yield (c1 + c2, pos2)
+
+class ConcatParser(Parser):
+    """Парсер --- конкатенация произвольного числа парсеров.
+
+    Цепочка p1 + p2 + ... + pk выравнивается оператором + в один такой
+    парсер вместо дерева вложенных SeqParser: обход ведется явным стеком
+    генераторов, без генератора на каждый уровень вложенности, а итоговая
+    составляющая строится один раз на каждое полное совпадение, без
+    промежуточных составляющих от попарных сложений"""
+
+    def __init__(self, *ps):
+        self.ps = tuple(ps)
+
+    @memo
+    def __call__(self, tokens, pos=0):
+        """Итеративный перебор: на вершине стека gens --- генератор
+        очередного дочернего парсера, parts хранит составляющие,
+        выбранные для всех уровней ниже вершины"""
+        # горячий цикл: атрибуты и методы привязаны к локальным именам
+        ps = self.ps
+        k = len(ps)
+        gens = [ps[0](tokens, pos)]
+        gens_append = gens.append
+        gens_pop = gens.pop
+        parts = []
+        parts_append = parts.append
+        parts_pop = parts.pop
+        make = Constituent
+        while gens:
+            try:
+                c, pos1 = next(gens[-1])
+            except StopIteration:
+                gens_pop()
+                if gens:
+                    parts_pop()
+                continue
+            if len(gens) == k:
+                children = tuple(parts) + (c,)
+                chunks = tuple(chunk for child in children
+                               for chunk in child._word_chunks)
+                yield (make(children=children, word_chunks=chunks), pos1)
+            else:
+                parts_append(c)
+                gens_append(ps[len(gens)](tokens, pos1))
+
+def _word_table(p):
+    """Возвращает таблицу идентификатор слова -> парсер для парсера p,
+    если p целиком состоит из альтернатив по одному слову (WordParser и
+    SetWordParser, в том числе под TagParser, и уже построенные таблицы
+    вложенных AltParser); иначе None"""
+    if isinstance(p, WordParser):
+        return {p.wid: p}
+    if isinstance(p, SetWordParser):
+        return {wid: p for wid in p.ws}
+    if isinstance(p, TagParser):
+        if isinstance(p.p, WordParser):
+            return {p.p.wid: p}
+        if isinstance(p.p, SetWordParser):
+            return {wid: p for wid in p.p.ws}
+    if isinstance(p, AltParserN) and p.table is not None:
+        return dict(p.table)
+    return None
+
+class AltParserN(Parser):
+    """Парсер --- альтерация произвольного числа парсеров.
 
-class AltParser(Parser):
-    """Парсер --- альтерация парсеров"""
+    Цепочка p1 | p2 | ... | pk выравнивается оператором | в один такой
+    парсер, и альтернативы перебираются одним циклом по кортежу вместо
+    O(k) вложенных генераторов. Если все альтернативы однословные, при
+    построении дополнительно компилируется таблица идентификатор
+    первого слова -> парсер, и выбор ветви становится одним обращением
+    к словарю (LL(1)-диспетчеризация)"""
+
+    def __init__(self, *ps):
+        self.ps = tuple(ps)
+        table = {}
+        for p in self.ps:
+            t = _word_table(p)
+            if t is None or table.keys() & t.keys():
+                # неоднословная альтернатива или пересечение слов
+                # (оно меняло бы порядок результатов) --- остается
+                # общий перебор
+                table = None
+                break
+            table.update(t)
+        self.table = table
+
+    @memo
+    def __call__(self, tokens, pos=0):
+        """Диспетчеризация по таблице, если она есть; иначе варианты
+        разбора всех альтернатив возвращаются последовательно"""
+        table = self.table
+        if table is not None:
+            if pos < len(tokens):
+                p = table.get(tokens[pos])
+                if p is not None:
+                    yield from p(tokens, pos)
+            return
+        for p in self.ps:
+            yield from p(tokens, pos)
+
+class AltParser(AltParserN):
+    """Парсер --- альтерация двух парсеров (бинарный частный случай
+    AltParserN)"""
 
     def __init__(self, p1, p2):
+        super().__init__(p1, p2)
         self.p1 = p1
         self.p2 = p2
 
-    def __call__(self, tokens):
-        """Возвращаются последовательно варианты разбора от обоих парсеров"""
-        yield from self.p1(tokens)
-        yield from self.p2(tokens)
-
 class TagParser(Parser):
     """Парсер, снабжающий меткой результат нижележащего парсера"""
 
@@ -112,10 +380,11 @@ class TagParser(Parser):
         self.p = p
         self.tag = tag
 
-    def __call__(self, tokens):
+    @memo
+    def __call__(self, tokens, pos=0):
         """Метки составляющих заменяются на tag"""
-        for c, tokens1 in self.p(tokens):
-            yield (c @ self.tag, tokens1)
+        for c, pos1 in self.p(tokens, pos):
+            yield (c @ self.tag, pos1)
 
 
 class FilterParser(Parser):
@@ -129,12 +398,38 @@ class FilterParser(Parser):
         чтобы определять валидность составляющей c"""
         return True
 
-    def __call__(self, tokens):
+    @memo
+    def __call__(self, tokens, pos=0):
         """Возвращаются только те результаты нижележащего
         парсера, составляющая которых удовлетворяет методу predicate"""
-        for c, tokens1 in self.p(tokens):
+        for c, pos1 in self.p(tokens, pos):
             if self.predicate(c):
-                yield (c, tokens1)
+                yield (c, pos1)
+
+class GuardParser(FilterParser):
+    """Парсер-страж: предикат протолкнут внутрь --- guard проверяется по
+    самим токенам до запуска нижележащего парсера, так что обреченные
+    ветви отсекаются без построения составляющих (в отличие от
+    FilterParser, который сначала строит результат и лишь потом его
+    отбрасывает).
+
+    Необязательный predicate --- эквивалентная проверка по готовой
+    составляющей; сам __call__ ее не применяет, но через наследование
+    от FilterParser ее подхватывают бэкенды вроде Эрли, которым нечего
+    проверять до разбора"""
+
+    def __init__(self, p, guard, predicate=None):
+        super().__init__(p)
+        self.guard = guard
+        if predicate is not None:
+            self.predicate = predicate
+
+    @memo
+    def __call__(self, tokens, pos=0):
+        """Сначала дешевая проверка guard по токенам, затем обычный
+        запуск нижележащего парсера"""
+        if self.guard(tokens, pos):
+            yield from self.p(tokens, pos)
 
 class RecursiveParser(Parser):
     """Парсер --- рекурсивное замыкание.
@@ -150,9 +445,10 @@ class RecursiveParser(Parser):
     def __init__(self, fp):
         self.p = fp(self)
 
-    def __call__(self, tokens):
+    @memo
+    def __call__(self, tokens, pos=0):
         """Вызывает рекурсивно замкнутый нижележащий парсер"""
-        yield from self.p(tokens)
+        yield from self.p(tokens, pos)
 
 
 class WholeParser(Parser):
@@ -161,12 +457,30 @@ class WholeParser(Parser):
     def __init__(self, p):
         self.p = p
 
-    def __call__(self, tokens):
+    def __call__(self, tokens, pos=0):
         """Возвращает только те результаты нижележащего парсера,
-        у который хвост --- пустая цепочка"""
-        for c, tokens1 in self.p(tokens):
-            if not tokens1:
-                yield (c, tokens1)
+        которые поглотили цепочку до конца. Цепочка слов один раз
+        переводится в кортеж целочисленных идентификаторов, дальше
+        парсеры работают с позициями в нем"""
+        tokens = tuple(tokens)
+        if not (tokens and isinstance(tokens[0], int)):
+            tokens = tokenize(tokens)
+        for c, pos1 in self.p(tokens, pos):
+            if pos1 == len(tokens):
+                yield (c, pos1)
+
+class FirstWholeParser(WholeParser):
+    """Парсер законченных выражений, останавливающийся на первом успехе.
+
+    WholeParser перечисляет все полные разборы, даже если вызывающему
+    нужен только первый; здесь перебор обрывается сразу после первого
+    полного разбора --- приоритетный выбор в духе PEG"""
+
+    def __call__(self, tokens, pos=0):
+        """Выдает не более одной пары и прекращает перебор"""
+        for result in super().__call__(tokens, pos):
+            yield result
+            return
 
 def word(w):
     """Сокращение для конструктора WordParser"""
@@ -180,6 +494,168 @@ def whole(p):
     """Сокращение для конструктора WholeParser"""
     return WholeParser(p)
 
+def first_whole(p):
+    """Сокращение для конструктора FirstWholeParser"""
+    return FirstWholeParser(p)
+
+def parse(p, tokens):
+    """Обертка над позиционным интерфейсом парсеров в старом стиле:
+    переводит слова в идентификаторы и выдает пары
+    (составляющая, хвост цепочки слов в виде списка)"""
+    tokens = list(tokens)
+    for c, pos in p(tokenize(tokens), 0):
+        yield (c, tokens[pos:])
+
+
+def _compile_ops(parser):
+    """Компилирует дерево комбинаторов в плоский список команд для
+    MachineParser.
+
+    Команды (кортежи, первый элемент --- код):
+    - ('MATCH', wid, лист): принять слово с идентификатором wid
+    - ('SET', множество, кэш): принять слово из множества
+    - ('ALT', адрес): запомнить точку возврата на адрес
+    - ('JMP', адрес): безусловный переход
+    - ('CALL', адрес) / ('RET',): подпрограмма рекурсивного парсера
+    - ('REDUCE', k): свернуть k верхних составляющих в одну
+    - ('TAG', метка): пометить верхнюю составляющую
+    - ('STOP',): выдать верхнюю составляющую как результат"""
+
+    ops = []
+    subs = {}
+    pending = []
+
+    def emit(p):
+        if isinstance(p, WordParser):
+            ops.append(('MATCH', p.wid, p._leaf))
+        elif isinstance(p, SetWordParser):
+            ops.append(('SET', p.ws, p.cache))
+        elif isinstance(p, TagParser):
+            emit(p.p)
+            ops.append(('TAG', p.tag))
+        elif isinstance(p, ConcatParser):
+            for child in p.ps:
+                emit(child)
+            ops.append(('REDUCE', len(p.ps)))
+        elif isinstance(p, SeqParser):
+            emit(p.p1)
+            emit(p.p2)
+            ops.append(('REDUCE', 2))
+        elif isinstance(p, AltParserN):
+            jumps = []
+            for child in p.ps[:-1]:
+                alt_at = len(ops)
+                ops.append(None)
+                emit(child)
+                jumps.append(len(ops))
+                ops.append(None)
+                ops[alt_at] = ('ALT', len(ops))
+            emit(p.ps[-1])
+            for j in jumps:
+                ops[j] = ('JMP', len(ops))
+        elif isinstance(p, RecursiveParser):
+            if id(p) not in subs:
+                subs[id(p)] = None
+                pending.append(p)
+            ops.append(('CALL', id(p)))
+        else:
+            raise ValueError(f"парсер {type(p).__name__} не компилируется в команды")
+
+    emit(parser)
+    ops.append(('STOP',))
+    while pending:
+        p = pending.pop()
+        subs[id(p)] = len(ops)
+        emit(p.p)
+        ops.append(('RET',))
+    # подстановка настоящих адресов подпрограмм вместо id парсеров
+    for i, op in enumerate(ops):
+        if op[0] == 'CALL':
+            ops[i] = ('CALL', subs[op[1]])
+    return ops
+
+
+class MachineParser(Parser):
+    """Парсер, исполняющий дерево комбинаторов как плоский список команд.
+
+    Вместо вложенных генераторов и рекурсии Python --- один цикл с
+    явными стеками: out для построенных составляющих, calls для адресов
+    возврата подпрограмм, alts для точек отката. Глубина разбора
+    ограничена только памятью, а не лимитом рекурсии, и на весь разбор
+    приходится один кадр Python"""
+
+    def __init__(self, p):
+        self.source = p
+        self.ops = _compile_ops(p)
+
+    def __call__(self, tokens, pos=0):
+        """Исполняет команды; при неудаче или после выдачи результата
+        откатывается к последней точке ALT и продолжает перебор"""
+        ops = self.ops
+        n = len(tokens)
+        out = []
+        calls = []
+        # точки отката: (адрес, позиция, снимок out, снимок calls);
+        # out нужно снимать целиком: REDUCE мог свернуть и те элементы,
+        # что лежали ниже вершины в момент создания точки
+        alts = []
+        pc = 0
+        while True:
+            op = ops[pc]
+            kind = op[0]
+            if kind == 'MATCH':
+                if pos < n and tokens[pos] == op[1]:
+                    out.append(op[2])
+                    pos += 1
+                    pc += 1
+                    continue
+            elif kind == 'SET':
+                if pos < n and tokens[pos] in op[1]:
+                    out.append(op[2][tokens[pos]])
+                    pos += 1
+                    pc += 1
+                    continue
+            elif kind == 'REDUCE':
+                k = op[1]
+                children = tuple(out[-k:])
+                del out[-k:]
+                out.append(Constituent(
+                    children=children,
+                    word_chunks=tuple(chunk for child in children
+                                      for chunk in child._word_chunks)))
+                pc += 1
+                continue
+            elif kind == 'TAG':
+                out[-1] = out[-1] @ op[1]
+                pc += 1
+                continue
+            elif kind == 'ALT':
+                alts.append((op[1], pos, tuple(out), tuple(calls)))
+                pc += 1
+                continue
+            elif kind == 'JMP':
+                pc = op[1]
+                continue
+            elif kind == 'CALL':
+                calls.append(pc + 1)
+                pc = op[1]
+                continue
+            elif kind == 'RET':
+                pc = calls.pop()
+                continue
+            else:  # STOP
+                yield (out[-1], pos)
+            # неудача или выданный результат: откат к последней точке ALT
+            if not alts:
+                return
+            pc, pos, saved_out, saved_calls = alts.pop()
+            out = list(saved_out)
+            calls = list(saved_calls)
+
+def machine(p):
+    """Сокращение для конструктора MachineParser"""
+    return MachineParser(p)
+
 
 N = (word('fox') | word('wolf') | word('ant') | word('table')) @ 'N'
 Adj = (word('quick') | word('brown') | word('table') | word('caught') |
@@ -187,54 +663,301 @@ Adj = (word('quick') | word('brown') | word('table') | word('caught') |
 Compl = (word('a') | word('an') | word('the')) @ 'Compl'
 V = (word('jump') | word('jumped') | word('caught')) @ 'V'
 
+# битовые маски лексических категорий: по идентификатору слова можно
+# за одно обращение к таблице узнать, в каких категориях оно состоит
+_CAT_N, _CAT_ADJ, _CAT_COMPL, _CAT_V = 1, 2, 4, 8
+
+def _category_masks():
+    """Строит по лексикону таблицу идентификатор слова -> битовая маска
+    категорий (слово может состоять в нескольких, например table)"""
+    masks = [0] * len(_ID_WORD)
+    for parser, bit in ((N, _CAT_N), (Adj, _CAT_ADJ),
+                        (Compl, _CAT_COMPL), (V, _CAT_V)):
+        for wid in parser.p.ws:
+            masks[wid] |= bit
+    return tuple(masks)
+
+_CATEGORY = _category_masks()
+
+def scan_categories(tokens):
+    """Однопроходная классификация цепочки слов: для каждого слова
+    возвращается битовая маска его лексических категорий (0 ---
+    неизвестное слово). Один плотный цикл по таблице _CATEGORY вместо
+    прогона парсеров по каждому слову"""
+    masks = _CATEGORY
+    n = len(masks)
+    return tuple(masks[wid] if 0 <= wid < n else 0
+                 for wid in tokenize(tokens))
+
+_VOWELS = frozenset('aeiouAEIOU')
+
+def _valid_article(c):
+    """Истинно, если составляющая c не нарушает согласование артикля:
+    - у составляющей нет детей или первый ребенок --- не артикль
+    - первое слово "a", а второе слово не начинается с гласной
+    - первое слово "an", а второе слово начинается с гласной
+    - первое слово --- другой артикль ("the")
+
+    Проверка первой буквы --- одно обращение к множеству _VOWELS,
+    без регулярных выражений"""
+    if not c.children or c.children[0].tag != 'Compl':
+        return True
+
+    if c.words[0] == 'a':
+        return c.words[1][0] not in _VOWELS
+    if c.words[0] == 'an':
+        return c.words[1][0] in _VOWELS
+    return True
+
 class FilterValidArticle(FilterParser):
     """Подкласс FilterParser, который обеспечивает выбор корректного артикля"""
 
     def predicate(self, c):
-        """Предикат будет истинен:
-        - если у составляющей нет детей или первый ребенок --- не артикль
-        - если первое слово "a", а второе слово не начинается с гласной
-        - если первое слово "an", а второе слово начинается с гласной
-        - если первое слово --- другой артикль ("the")
-        """
-        if not c.children or c.children[0].tag != 'Compl':
-            return True
+        """Предикат корректности артикля (см. _valid_article)"""
+        return _valid_article(c)
+
+_WID_A = _intern('a')
+_WID_AN = _intern('an')
 
-        if c.words[0] == 'a':
-            return re.match('[^aeiou]', c.words[1])
-        if c.words[0] == 'an':
-            return re.match('[aeiou]', c.words[1])
+def _valid_article_ahead(tokens, pos):
+    """Предикат-страж группы Compl + NP0: прямо по токенам проверяет,
+    что артикль в позиции pos согласован с первой буквой следующего
+    слова и что следующее слово вообще может начинать именную группу
+    (битовая маска категорий). Эквивалент _valid_article, но срабатывает
+    до разбора, а не после"""
+    if pos + 1 >= len(tokens) or tokens[pos + 1] < 0:
         return True
+    nxt = tokens[pos + 1]
+    # после артикля может идти только существительное или прилагательное
+    if nxt < len(_CATEGORY) and not _CATEGORY[nxt] & (_CAT_N | _CAT_ADJ):
+        return False
+    art = tokens[pos]
+    first = _ID_WORD[nxt][0]
+    if art == _WID_A and first in _VOWELS:
+        return False
+    if art == _WID_AN and first not in _VOWELS:
+        return False
+    return True
 
 NP0 = recursive(lambda NP0: (N | Adj + NP0) @ 'NP')
-NP = FilterValidArticle(Compl + NP0) @ 'NP'
+NP = (Compl + NP0).lookahead(_valid_article_ahead, _valid_article) @ 'NP'
 
 VP = V @ 'VP'
 
 S = (NP + VP) @ 'S'
 
 
+def _compile_grammar(parser):
+    """Обходит дерево комбинаторов и извлекает из него КС-грамматику
+    для алгоритма Эрли.
+
+    Каждый TagParser (и каждый RecursiveParser/FilterParser) становится
+    нетерминалом, AltParser --- набором альтернативных правил, а
+    ConcatParser/SeqParser --- последовательностью символов в правой
+    части. Символы правой части: ('n', имя) --- нетерминал,
+    ('w', слово) --- терминал-слово, ('s', множество) --- терминал из
+    SetWordParser.
+
+    Возвращает кортеж (rules, tags, preds, start):
+    - rules: имя -> список правых частей
+    - tags: имя -> метка для итоговой составляющей (или None)
+    - preds: имя -> предикат-фильтр для построенной составляющей
+    - start: имя стартового нетерминала"""
+
+    rules = {}
+    tags = {}
+    preds = {}
+    seen = {}
+
+    def nonterm(p, tag, body, pred):
+        name = f"{tag if tag is not None else '_'}#{len(rules)}"
+        seen[id(p)] = name
+        rules[name] = []
+        tags[name] = tag
+        if pred is not None:
+            preds[name] = pred
+        rules[name] = alternatives(body)
+        return ('n', name)
+
+    def symbol(p):
+        if id(p) in seen:
+            return ('n', seen[id(p)])
+        if isinstance(p, WordParser):
+            return ('w', p.w)
+        if isinstance(p, SetWordParser):
+            return ('s', p.words)
+        if isinstance(p, TagParser):
+            return nonterm(p, p.tag, p.p, None)
+        if isinstance(p, RecursiveParser):
+            return nonterm(p, None, p.p, None)
+        if isinstance(p, FilterParser):
+            return nonterm(p, None, p.p, p.predicate)
+        if isinstance(p, (AltParserN, SeqParser, ConcatParser)):
+            return nonterm(p, None, p, None)
+        raise ValueError(f"парсер {type(p).__name__} не переводится в КС-грамматику")
+
+    def alternatives(p):
+        if isinstance(p, AltParserN):
+            return [alt for child in p.ps for alt in alternatives(child)]
+        return [sequence(p)]
+
+    def sequence(p):
+        if isinstance(p, ConcatParser):
+            return tuple(symbol(child) for child in p.ps)
+        if isinstance(p, SeqParser):
+            return sequence(p.p1) + sequence(p.p2)
+        return (symbol(p),)
+
+    while isinstance(parser, WholeParser):
+        parser = parser.p
+    start = symbol(parser)
+    if start[0] != 'n':
+        name = f"_#{len(rules)}"
+        rules[name] = [(start,)]
+        tags[name] = None
+        start = ('n', name)
+    return rules, tags, preds, start[1]
+
+
+def earley(p, tokens):
+    """Разбор по алгоритму Эрли вместо нисходящего перебора.
+
+    Грамматика извлекается из того же дерева комбинаторов p, после чего
+    выполняются стандартные шаги predict/scan/complete над таблицей
+    chart[i]; общие поддеревья при этом выводятся по одному разу, и
+    худший случай --- O(n^3) вместо экспоненциального возврата.
+    Как и whole(p), выдает пары (составляющая, длина цепочки) для
+    разборов, поглотивших цепочку целиком"""
+
+    tokens = tuple(tokens)
+    n = len(tokens)
+    rules, tags, preds, start = _compile_grammar(p)
+
+    # элементы таблицы: (имя, номер правила, позиция точки, начало)
+    chart = [set() for _ in range(n + 1)]
+    # done[(имя, начало)]: конец -> множество номеров завершенных правил
+    done = {}
+
+    for ri in range(len(rules[start])):
+        chart[0].add((start, ri, 0, 0))
+
+    for i in range(n + 1):
+        agenda = list(chart[i])
+        while agenda:
+            item = agenda.pop()
+            name, ri, dot, org = item
+            prod = rules[name][ri]
+            if dot == len(prod):
+                # complete: правило закончено, продвигаем ожидающих
+                done.setdefault((name, org), {}).setdefault(i, set()).add(ri)
+                for name2, ri2, dot2, org2 in list(chart[org]):
+                    prod2 = rules[name2][ri2]
+                    if dot2 < len(prod2) and prod2[dot2] == ('n', name):
+                        moved = (name2, ri2, dot2 + 1, org2)
+                        if moved not in chart[i]:
+                            chart[i].add(moved)
+                            agenda.append(moved)
+                continue
+            sym = prod[dot]
+            if sym[0] == 'n':
+                # predict: ставим правила ожидаемого нетерминала
+                for ri2 in range(len(rules[sym[1]])):
+                    item2 = (sym[1], ri2, 0, i)
+                    if item2 not in chart[i]:
+                        chart[i].add(item2)
+                        agenda.append(item2)
+            elif i < n:
+                # scan: терминал сверяется с очередным токеном
+                if (tokens[i] == sym[1] if sym[0] == 'w' else tokens[i] in sym[1]):
+                    chart[i + 1].add((name, ri, dot + 1, org))
+
+    def build(name, i, j, path):
+        """Восстанавливает составляющие нетерминала name на отрезке i..j,
+        двигаясь только по завершенным элементам из done"""
+        key = (name, i, j)
+        if key in path:
+            return
+        path = path | {key}
+        for ri in done.get((name, i), {}).get(j, ()):
+            prod = rules[name][ri]
+            tag = tags[name]
+            pred = preds.get(name)
+            for children in build_seq(prod, 0, i, j, path):
+                if len(prod) == 1:
+                    c = children[0] if tag is None else children[0] @ tag
+                else:
+                    words = tuple(w for child in children for w in child.words)
+                    c = Constituent(tag=tag, children=children, words=words)
+                if pred is None or pred(c):
+                    yield c
+
+    def build_seq(prod, k, i, j, path):
+        """Перебирает разбиения отрезка i..j под символы prod[k:]"""
+        if k == len(prod):
+            if i == j:
+                yield ()
+            return
+        sym = prod[k]
+        if sym[0] != 'n':
+            if i < j and (tokens[i] == sym[1] if sym[0] == 'w' else tokens[i] in sym[1]):
+                for rest in build_seq(prod, k + 1, i + 1, j, path):
+                    yield (Constituent(words=(tokens[i],)),) + rest
+            return
+        for mid in done.get((sym[1], i), {}):
+            if mid > j or (k == len(prod) - 1 and mid != j):
+                continue
+            for c in build(sym[1], i, mid, path):
+                for rest in build_seq(prod, k + 1, mid, j, path):
+                    yield (c,) + rest
+
+    for c in build(start, 0, n, frozenset()):
+        yield (c, n)
+
+
 class StarParser:
-    """Парсер-звездочка, вызывает нижележащий парсер ноль или более раз"""
+    """Парсер-звездочка, вызывает нижележащий парсер ноль или более раз.
+
+    Если нижележащий парсер однословный (WordParser или SetWordParser),
+    при построении готовится таблица идентификатор слова ->
+    составляющая-лист, и сканирование идет простым циклом по токенам,
+    вообще без генераторов нижележащего парсера"""
+
     def __init__(self, p):
         self.p = p
+        if isinstance(p, WordParser):
+            self.leaves = {p.wid: p._leaf}
+        elif isinstance(p, SetWordParser):
+            self.leaves = dict(p.cache)
+        else:
+            self.leaves = None
 
-    def __call__(self, tokens):
+    def __call__(self, tokens, pos=0):
+        n = len(tokens)
+        leaves = self.leaves
         children = []
-        while tokens:
-            result = None # возвращает пустую составляющую
-            for res in self.p(tokens):
-                result = res
-                break  # выходим из цикла, так как нам нужен только первый результат
 
-            if result is None or result[0] is None:
-                break
+        if leaves is not None:
+            # быстрый путь: один плотный цикл по токенам,
+            # метод добавления привязан к локальному имени
+            append = children.append
+            while pos < n and tokens[pos] in leaves:
+                append(leaves[tokens[pos]])
+                pos += 1
+        else:
+            # общий случай: каждый раз берется только первый результат
+            while pos < n:
+                result = next(self.p(tokens, pos), None)
 
-            (tree, remainder) = result # сохраняем результат и его "хвост"
-            children.append(tree)
-            tokens = remainder # перезаписываем остаточные токены в виде "хвоста"
+                if result is None or result[0] is None:
+                    break
 
-        yield Constituent(children=tuple(children), words=tuple(word for child in children for word in child.words)), tokens
+                (tree, pos1) = result # сохраняем результат и позицию после него
+                children.append(tree)
+                pos = pos1 # продолжаем разбор с новой позиции
+
+        yield Constituent(children=tuple(children),
+                          word_chunks=tuple(chunk for child in children
+                                            for chunk in child._word_chunks)), pos
 
 
 
@@ -245,7 +968,7 @@ def star(p):
 
 def test_star_parser():
     p1 = star(word('a'))
-    result1 = list(p1(['a', 'b']))[0]
+    result1 = list(parse(p1, ['a', 'b']))[0]
     expected1 = (
         Constituent(children=(
             Constituent(words=('a',), children=()),)
@@ -256,7 +979,7 @@ def test_star_parser():
     print(f"Test passed for result1: {result1}")
     
     p2 = star(word('a') | word('b'))
-    result2 = list(p2(['a', 'b', 'c']))[0]
+    result2 = list(parse(p2, ['a', 'b', 'c']))[0]
     expected2 = (
         Constituent(children=(
             Constituent(words=('a',), children=()),
@@ -269,7 +992,7 @@ def test_star_parser():
     
     
     p3 = star(word('a') | word('b'))
-    result3 = list(p3(['a', 'b', 'b']))[0]
+    result3 = list(parse(p3, ['a', 'b', 'b']))[0]
     expected3 = (
         Constituent(children=(
             Constituent(words=('a',), children=()),
@@ -283,13 +1006,44 @@ def test_star_parser():
     
     
     p4 = star(word('a') | word('b'))
-    result4 = list(p4(['c']))[0]
+    result4 = list(parse(p4, ['c']))[0]
     expected4 = (
         Constituent(children=(), words=()),
         ['c']
     )
     assert result4 == expected4, f"Expected {expected4}, but got {result4}"
     print(f"Test passed for result4: {result4}")
-    
-    
-test_star_parser()
\ No newline at end of file
+
+
+def test_earley():
+    sentences = [
+        ['the', 'quick', 'fox', 'jumped'],
+        ['an', 'adorable', 'ant', 'caught'],
+        ['an', 'fox', 'jumped'],
+    ]
+    for sentence in sentences:
+        expected = [str(c) for c, pos in whole(S)(sentence)]
+        result = [str(c) for c, pos in earley(S, sentence)]
+        assert result == expected, f"Expected {expected}, but got {result}"
+        print(f"Test passed for earley: {sentence} -> {result}")
+
+
+def test_machine_parser():
+    mp = machine(NP0)
+    sentences = [
+        ['quick', 'brown', 'fox'],
+        ['table', 'table', 'fox'],
+        ['fox'],
+        ['jumped'],
+    ]
+    for sentence in sentences:
+        tokens = tokenize(sentence)
+        expected = [(str(c), pos) for c, pos in NP0(tokens)]
+        result = [(str(c), pos) for c, pos in mp(tokens)]
+        assert result == expected, f"Expected {expected}, but got {result}"
+        print(f"Test passed for machine: {sentence} -> {result}")
+
+
+test_star_parser()
+test_earley()
+test_machine_parser()
\ No newline at end of file